@@ -0,0 +1,110 @@
+import numpy as np
+import numexpr as ne
+from netCDF4 import Dataset
+
+
+# (offset, divisor) to get the data in appropriate units for models
+_UNIT_CONVERSIONS = {
+    't2m' : (-273.15,1.), # convert to Celsius from Kelvin
+    'ssrd' : (0.,3600.), # convert Jh-1m-2 to Wm-2
+}
+
+
+def _slice_coords(dataset,slicer=None):
+
+    """
+    Reads the latitudes and longitudes of an open ERA5 dataset and the
+    slices of the grid given by slicer (the whole grid if slicer is None).
+    """
+
+    lons = dataset.variables['longitude'][:]
+    lats = dataset.variables['latitude'][:]
+    if slicer is None:
+        lat_slice, lon_slice = slice(None), slice(None)
+    else:
+        lat_slice, lon_slice = slicer(lats,lons)
+        lats, lons = lats[lat_slice], lons[lon_slice]
+
+    return(lats,lons,lat_slice,lon_slice)
+
+
+def _read_era5_coords(file_str,slicer=None):
+
+    """
+    This function loads only the latitudes and longitudes of an ERA5 .netcdf
+    file, sliced the same way as _read_era5 with the same slicer.
+
+    Args:
+        file_str (str): The path and filename of a .netcdf file
+            e.g. '/home/users/zd907959/ERA5_1979_01.nc'
+
+        slicer (function): Optional, see _read_era5.
+
+    Returns:
+
+        lats (array): Dimensions [lat] The latitudes of the (sliced) grid.
+
+        lons (array): Dimensions [lon] The longitudes of the (sliced) grid.
+
+    """
+
+    dataset = Dataset(file_str,mode='r')
+    lats, lons = _slice_coords(dataset,slicer)[:2]
+    dataset.close()
+
+    return(lats,lons)
+
+
+def _read_era5(file_str,nc_key,slicer=None):
+
+    """
+    This function loads a variable from an ERA5 .netcdf file in float32 and
+    in the units used by the models. ERA5 data is stored as int16 with a
+    scale_factor and add_offset, these are applied along with the unit
+    conversion in a single pass rather than netCDF4 unpacking it to float64.
+
+    Args:
+        file_str (str): The path and filename of a .netcdf file
+            e.g. '/home/users/zd907959/ERA5_1979_01.nc'
+
+        nc_key (str): The string you need to load the .nc data
+            e.g. 't2m','rsds'
+
+        slicer (function): Optional, takes the (lats,lons) of the file and
+            returns the (lat_slice,lon_slice) of the part of the grid to read,
+            so only that part is read from disk.
+
+    Returns:
+
+        data (array): Dimensions [time,lat,lon] The weather data in float32,
+            missing values are nan.
+
+        lats (array): Dimensions [lat] The latitudes of the data.
+
+        lons (array): Dimensions [lon] The longitudes of the data.
+
+    """
+
+    dataset = Dataset(file_str,mode='r')
+    lats, lons, lat_slice, lon_slice = _slice_coords(dataset,slicer)
+
+    variable = dataset.variables[nc_key]
+    variable.set_auto_maskandscale(False)
+    raw = variable[:,lat_slice,lon_slice] # data in shape [time,lat,lon]
+    scale_factor = np.float32(getattr(variable,'scale_factor',1.))
+    add_offset = np.float32(getattr(variable,'add_offset',0.))
+    fill_value = getattr(variable,'_FillValue',getattr(variable,'missing_value',None))
+    dataset.close()
+
+    unit_offset, unit_divisor = _UNIT_CONVERSIONS.get(nc_key,(0.,1.))
+    data = ne.evaluate('(raw*scale_factor + add_offset + unit_offset)/unit_divisor',
+                       local_dict={'raw':raw,'scale_factor':scale_factor,
+                                   'add_offset':add_offset,
+                                   'unit_offset':np.float32(unit_offset),
+                                   'unit_divisor':np.float32(unit_divisor)})
+    data = data.astype(np.float32,copy=False)
+
+    if fill_value is not None:
+        data[raw == fill_value] = np.nan
+
+    return(data,lats,lons)
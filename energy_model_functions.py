@@ -1,10 +1,382 @@
+import os
+import hashlib
+import functools
+import collections
+import concurrent.futures
+import multiprocessing
 import numpy as np
-import cartopy.io.shapereader as shpreader
-from netCDF4 import Dataset
+import numexpr as ne
+from _era5_io import _read_era5, _read_era5_coords
 import shapely.geometry
+from shapely.prepared import prep
+try:
+    from shapely import contains_xy
+except ImportError: # shapely < 2.0 only has the (now deprecated) vectorized module
+    try:
+        from shapely.vectorized import contains as contains_xy
+    except ImportError: # older shapely builds without the vectorized module
+        contains_xy = None
+# cartopy, geopandas, numba, rasterio and xarray are slow to import, so they 
+# are imported in the functions that use them to keep importing this module 
+# cheap. the numba kernels are compiled the first time they are used, see _jit
+prange = range
 
 
-def load_country_weather_data(COUNTRY,data_dir,filename,nc_key):
+# the timeseries returned by compute_country_timeseries
+CountryTimeseries = collections.namedtuple('CountryTimeseries',
+                                           ['mean_t2m','mean_ssrd','solar_cf',
+                                            'HDD','CDD'])
+
+# the numba.njit options of each of the kernels compiled by _jit
+_JIT_OPTIONS = {
+    '_pip_raycast' : {'parallel':True,'cache':True},
+    # fastmath without the nnan and ninf flags, so missing data (nan) is kept
+    '_hdd_cdd_weighted' : {'parallel':True,'fastmath':{'reassoc','contract'},
+                           'cache':True},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _jit(name):
+
+    """
+    This function compiles one of the kernels in this module (e.g. 
+    '_pip_raycast') with numba the first time it is needed, so numba is only
+    imported when it is used. Returns None if numba is not installed.
+    """
+
+    try:
+        import numba
+    except ImportError: # numba is only needed for the kernels
+        return(None)
+
+    # numba only runs the prange loops of the kernels in parallel if prange 
+    # is numba.prange (which is range when not compiled)
+    global prange
+    prange = numba.prange
+
+    return(numba.njit(**_JIT_OPTIONS[name])(globals()[name]))
+
+
+def _polygon_rings(geometry):
+
+    """
+    This function gets the vertices of all the rings (exteriors and holes)
+    of a shapely Polygon or MultiPolygon, stacked one after another.
+
+    Args:
+        geometry (shapely geometry): The country Polygon or MultiPolygon.
+
+    Returns:
+
+        ring_x (array): Dimensions [vertices] The longitudes of the vertices.
+
+        ring_y (array): Dimensions [vertices] The latitudes of the vertices.
+
+        ring_ends (array): Dimensions [rings] The index after the last vertex
+            of each ring.
+
+    """
+
+    rings = []
+    for polygon in getattr(geometry,'geoms',[geometry]):
+        rings.append(np.asarray(polygon.exterior.coords))
+        for interior in polygon.interiors:
+            rings.append(np.asarray(interior.coords))
+
+    vertices = np.concatenate(rings)
+    ring_ends = np.cumsum([len(ring) for ring in rings])
+
+    return(np.ascontiguousarray(vertices[:,0]),np.ascontiguousarray(vertices[:,1]),
+           ring_ends)
+
+
+def _pip_raycast(px,py,ring_x,ring_y,ring_ends):
+
+    """
+    This function tests which points are within a polygon by casting a ray
+    from each point and counting the ring edges it crosses. Crossings are 
+    counted over every ring, so holes and multipolygons are handled. It is 
+    compiled with numba by _jit and runs in parallel over points.
+
+    Args:
+        px (array): Dimensions [points] The longitudes of the points.
+
+        py (array): Dimensions [points] The latitudes of the points.
+
+        ring_x, ring_y, ring_ends (array): The polygon rings, as returned by 
+            _polygon_rings.
+
+    Returns:
+
+        inside (array): Dimensions [points], True where a point is within 
+            the polygon.
+
+    """
+
+    inside = np.zeros(len(px),dtype=np.bool_)
+    for i in prange(len(px)):
+        crossings = False
+        start = 0
+        for r in range(len(ring_ends)):
+            for j in range(start,ring_ends[r]-1):
+                x1, y1 = ring_x[j], ring_y[j]
+                x2, y2 = ring_x[j+1], ring_y[j+1]
+                if (y1 > py[i]) != (y2 > py[i]):
+                    if px[i] < (x2-x1)*(py[i]-y1)/(y2-y1) + x1:
+                        crossings = not crossings
+            start = ring_ends[r]
+        inside[i] = crossings
+
+    return(inside)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_country_geometry(COUNTRY):
+
+    """
+    This function finds the shapefile of a country in the natural_earth data.
+    It is cached in memory so the shapefile is only read once per country.
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+    Returns:
+
+        country_shapely (list): The shapely geometries of the country.
+
+    """
+
+    import cartopy.io.shapereader as shpreader
+    try:
+        import geopandas as gpd
+    except ImportError: # without geopandas the shapefile is read with cartopy
+        gpd = None
+
+    # first loop through the countries and extract the appropraite shapefile
+    countries_shp = shpreader.natural_earth(resolution='10m',category='cultural',
+                                            name='admin_0_countries')
+    if gpd is not None:
+        # let the OGR driver filter the records, so only the country is read
+        country_filter = "NAME_LONG = '" + COUNTRY.replace("'","''") + "'"
+        country_shapely = list(gpd.read_file(countries_shp,
+                                             where=country_filter).geometry)
+        if len(country_shapely) > 0:
+            print('Found country')
+    else:
+        country_shapely = []
+        for country in shpreader.Reader(countries_shp).records():
+            if country.attributes['NAME_LONG'] == COUNTRY:
+                print('Found country')
+                country_shapely.append(country.geometry)
+
+    return(country_shapely)
+
+
+def _country_slices(COUNTRY,lats,lons):
+
+    """
+    This function finds the slices of the lat/lon grid that cover the 
+    bounding box of a country, so only that part of a file needs to be read.
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+        lats (array): Dimensions [lat] The latitudes of the grid.
+
+        lons (array): Dimensions [lon] The longitudes of the grid.
+
+    Returns:
+
+        lat_slice (slice): The slice of the latitude dimension.
+
+        lon_slice (slice): The slice of the longitude dimension.
+
+    """
+
+    minx, miny, maxx, maxy = _load_country_geometry(COUNTRY)[0].bounds
+
+    # works for ascending or descending (as in ERA5) coordinates
+    slices = []
+    for coords, low, high in [(lats,miny,maxy),(lons,minx,maxx)]:
+        in_box = np.flatnonzero((coords>=low)&(coords<=high))
+        if len(in_box) == 0:
+            slices.append(slice(0,0))
+        else:
+            slices.append(slice(in_box[0],in_box[-1]+1))
+
+    return(slices[0],slices[1])
+
+
+def _rasterize_country_mask(geometry,lats,lons):
+
+    """
+    This function builds the country mask by rasterizing the country polygon
+    onto a regular lat/lon grid with rasterio, which works along the polygon 
+    edges in one pass rather than testing every gridpoint. A gridpoint is 
+    within the country if the polygon covers its centre (the lat/lon).
+
+    Args:
+        geometry (shapely geometry): The country Polygon or MultiPolygon.
+
+        lats (array): Dimensions [lat] The (evenly spaced) latitudes of the grid.
+
+        lons (array): Dimensions [lon] The (evenly spaced) longitudes of the grid.
+
+    Returns:
+
+        MASK_MATRIX_RESHAPE (array): Dimensions [lat,lon] where there are 1's if 
+           the data is within a country border and zeros if data is outside a 
+           country border. 
+
+    """
+
+    try:
+        from rasterio import features
+        from affine import Affine
+    except ImportError:
+        raise ImportError("rasterio is needed for the 'rasterio' mask backend")
+
+    lats = np.asarray(lats,dtype=np.float64)
+    lons = np.asarray(lons,dtype=np.float64)
+    dlat = (lats[-1] - lats[0])/(len(lats) - 1) if len(lats) > 1 else 1.
+    dlon = (lons[-1] - lons[0])/(len(lons) - 1) if len(lons) > 1 else 1.
+    if (not np.allclose(np.diff(lats),dlat)) or (not np.allclose(np.diff(lons),dlon)):
+        raise ValueError("the 'rasterio' mask backend needs a regular lat/lon grid")
+
+    # pixel (i,j) is centred on (lons[j],lats[i]), dlat is negative for ERA5
+    transform = (Affine.translation(lons[0] - dlon/2.,lats[0] - dlat/2.)*
+                 Affine.scale(dlon,dlat))
+    MASK_MATRIX_RESHAPE = features.rasterize([(geometry,1)],
+                                             out_shape=(len(lats),len(lons)),
+                                             transform=transform,dtype='uint8')
+
+    return(MASK_MATRIX_RESHAPE.astype(np.float32))
+
+
+@functools.lru_cache(maxsize=32)
+def _build_country_mask(COUNTRY,lats,lons,backend='shapely'):
+
+    """
+    This function builds the country mask for a lat/lon grid. It is cached
+    in memory, so the lats and lons must be passed in as tuples.
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+        lats (tuple): The latitudes of the grid.
+
+        lons (tuple): The longitudes of the grid.
+
+        backend (str): How to test which gridpoints are within the country, 
+            either 'shapely', 'numba' (ray casting on the polygon vertices) or
+            'rasterio' (rasterizing the polygon, regular grids only).
+
+    Returns:
+
+        MASK_MATRIX_RESHAPE (array): Dimensions [lat,lon] where there are 1's if 
+           the data is within a country border and zeros if data is outside a 
+           country border. 
+
+    """
+
+    country_shapely = _load_country_geometry(COUNTRY)
+
+    if backend == 'rasterio':
+        return(_rasterize_country_mask(country_shapely[0],lats,lons))
+
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    # only points inside the country's bounding box can be inside the country,
+    # so only the rows and columns of the grid within it are tested
+    minx, miny, maxx, maxy = country_shapely[0].bounds
+    lat_in = (lats>=miny)&(lats<=maxy)
+    lon_in = (lons>=minx)&(lons<=maxx)
+    # make grids of the lat and lon data within the box and flatten them
+    LONS, LATS = np.meshgrid(lons[lon_in],lats[lat_in])
+    x, y = LONS.ravel(), LATS.ravel()
+    # test the remaining lat/lon combinations in one call to get the masked points
+    if backend == 'numba':
+        pip_raycast = _jit('_pip_raycast')
+        if pip_raycast is None:
+            raise ImportError("numba is needed for the 'numba' mask backend")
+        ring_x, ring_y, ring_ends = _polygon_rings(country_shapely[0])
+        inside = pip_raycast(np.asarray(x,dtype=np.float64),
+                             np.asarray(y,dtype=np.float64),
+                             ring_x,ring_y,ring_ends)
+    elif backend != 'shapely':
+        raise ValueError("backend must be 'shapely', 'numba' or 'rasterio'")
+    elif contains_xy is not None:
+        inside = contains_xy(country_shapely[0],x,y)
+    else:
+        # prepare the geometry once so every point test reuses its index
+        prepared_country = prep(country_shapely[0])
+        inside = np.zeros(len(x),dtype=bool)
+        for i in range(0,len(x)):
+            inside[i] = prepared_country.contains(shapely.geometry.Point(x[i],y[i]))
+    # creates 1s and 0s where the country is
+    MASK_MATRIX_RESHAPE = np.zeros((len(lats),len(lons)),dtype=np.float32)
+    MASK_MATRIX_RESHAPE[np.ix_(lat_in,lon_in)] = inside.reshape(LONS.shape)
+
+    return(MASK_MATRIX_RESHAPE)
+
+
+def _load_country_mask(COUNTRY,lats,lons,cache_dir=None,backend='shapely'):
+
+    """
+    This function returns the country mask for a lat/lon grid, reusing the
+    in-memory cache and (if cache_dir is given) a .npy file on disk, as the 
+    mask is the same for every ERA5 file on the same grid.
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+        lats (array): Dimensions [lat] The latitudes of the grid.
+
+        lons (array): Dimensions [lon] The longitudes of the grid.
+
+        cache_dir (str): The path of a folder to save/load the mask from,
+            e.g. '/home/users/zd907959/masks/'. If None the mask is only
+            cached in memory.
+
+        backend (str): 'shapely', 'numba' or 'rasterio', see _build_country_mask.
+
+    Returns:
+
+        MASK_MATRIX_RESHAPE (array): Dimensions [lat,lon] where there are 1's if 
+           the data is within a country border and zeros if data is outside a 
+           country border. 
+
+    """
+
+    lats = np.asarray(lats,dtype=np.float64)
+    lons = np.asarray(lons,dtype=np.float64)
+
+    if cache_dir is not None:
+        grid_hash = hashlib.md5(COUNTRY.encode() + lats.tobytes() + 
+                                lons.tobytes()).hexdigest()
+        # the backends can differ on gridpoints on the border, so each one
+        # has its own file
+        mask_file = os.path.join(cache_dir,COUNTRY + '_' + backend + '_' + 
+                                 grid_hash + '.npy')
+        if os.path.exists(mask_file):
+            return(np.load(mask_file))
+
+    MASK_MATRIX_RESHAPE = _build_country_mask(COUNTRY,tuple(lats.tolist()),
+                                              tuple(lons.tolist()),backend).copy()
+
+    if cache_dir is not None:
+        np.save(mask_file,MASK_MATRIX_RESHAPE)
+
+    return(MASK_MATRIX_RESHAPE)
+
+
+def load_country_weather_data(COUNTRY,data_dir,filename,nc_key,cache_dir=None,
+                              backend='shapely',subset=False):
 
     """
     This function takes the ERA5 reanalysis data, loads it and applied a 
@@ -28,6 +400,17 @@ def load_country_weather_data(COUNTRY,data_dir,filename,nc_key):
         nc_key (str): The string you need to load the .nc data 
             e.g. 't2m','rsds'
 
+        cache_dir (str): Optional folder to save the country mask in, so 
+            it is only calculated once for each country and grid.
+
+        backend (str): How the country mask is calculated, 'shapely' 
+            (default), 'numba' or 'rasterio'.
+
+        subset (bool): If True only the bounding box of the country is read
+            from the file, and the data and mask returned cover that box 
+            rather than the whole grid. The lats/lons of the box are given by
+            load_country_weather_coords.
+
     Returns:
 
         country_masked_data (array): Country-masked weather data, dimensions 
@@ -41,52 +424,450 @@ def load_country_weather_data(COUNTRY,data_dir,filename,nc_key):
     """
 
 
-    # first loop through the countries and extract the appropraite shapefile
-    countries_shp = shpreader.natural_earth(resolution='10m',category='cultural',
-                                            name='admin_0_countries')
-    country_shapely = []
-    for country in shpreader.Reader(countries_shp).records():
-        if country.attributes['NAME_LONG'] == COUNTRY:
-            print('Found country')
-            country_shapely.append(country.geometry)
+    # load in the data you wish to mask, in appropriate units for models
+    if subset:
+        # only read the part of the grid around the country from disk
+        slicer = functools.partial(_country_slices,COUNTRY)
+    else:
+        slicer = None
+    data, lats, lons = _read_era5(data_dir + filename,nc_key,slicer)
+
+    # get the mask of the gridpoints within the country
+    MASK_MATRIX_RESHAPE = _load_country_mask(COUNTRY,lats,lons,cache_dir,backend)
+
+    # now apply the mask to the data that has been loaded in, in place so a
+    # second [time,lat,lon] array is not allocated. the gridpoints outside the
+    # country are set to zero (rather than multiplied by it, as nan*0 is nan):
+
+    np.copyto(data,0.,where=~MASK_MATRIX_RESHAPE.astype(bool))
+    country_masked_data = data
+                                     
+
+
+    return(country_masked_data,MASK_MATRIX_RESHAPE)
+
+
+def load_country_weather_coords(COUNTRY,data_dir,filename,subset=False):
+
+    """
+    This function returns the latitudes and longitudes of the grid returned
+    by load_country_weather_data for the same file, which with subset=True
+    are those of the bounding box of the country rather than the whole grid.
+    Only the coordinates are read from the file.
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+        data_dir (str): The parth for where the data is stored.
+            e.g '/home/users/zd907959/'
+
+        filename (str): The filename of a .netcdf file
+            e.g. 'ERA5_1979_01.nc'
+
+        subset (bool): The subset used when loading the data.
+
+    Returns:
+
+        lats (array): Dimensions [lat] The latitudes of the loaded data.
+
+        lons (array): Dimensions [lon] The longitudes of the loaded data.
+
+    """
+
+    if subset:
+        slicer = functools.partial(_country_slices,COUNTRY)
+    else:
+        slicer = None
+
+    return(_read_era5_coords(data_dir + filename,slicer))
 
-    # load in the data you wish to mask
-    file_str = data_dir + filename
-    dataset = Dataset(file_str,mode='r')
-    lons = dataset.variables['longitude'][:]
-    lats = dataset.variables['latitude'][:]
-    data = dataset.variables[nc_key][:] # data in shape [time,lat,lon]
-    dataset.close()
+
+
+def _given_slices(lat_slice,lon_slice,lats,lons):
+
+    """
+    A slicer for _read_era5 that always returns the slices it is given, it is 
+    used with functools.partial as (unlike a lambda) it can be pickled.
+    """
+
+    return(lat_slice,lon_slice)
+
+
+def _load_masked_cells(file_str,nc_key,lat_slice,lon_slice,box_cells):
+
+    """
+    This function loads the bounding box of a country from one ERA5 file and
+    returns only the gridpoints within the country, dimensions [time,n_cells],
+    it is run in the worker processes of load_country_weather_series so only
+    these gridpoints are sent back rather than the whole grid.
+
+    """
+
+    slicer = functools.partial(_given_slices,lat_slice,lon_slice)
+    data, lats, lons = _read_era5(file_str,nc_key,slicer)
+
+    return(data[:,box_cells])
+
+
+def load_country_weather_series(COUNTRY,data_dir,filenames,nc_key,workers=None,
+                                cache_dir=None,backend='shapely',subset=False):
+
+    """
+    This function loads a series of ERA5 files (e.g. every month of a 
+    multi-year run) and applies a country mask, as load_country_weather_data,
+    joining them into one timeseries. The files are read in parallel across 
+    processes, the mask is calculated once from the grid of the first file and
+    only the bounding box of the country is read from each file. All the files
+    must be on the same grid. For long runs use subset=True, as the data for 
+    the whole grid may not fit in memory.
+
+    The worker processes are started with forkserver (or spawn) rather than
+    fork, as forking after numba's parallel kernels have run is not safe, so
+    scripts calling this must do so under if __name__ == '__main__':
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+        data_dir (str): The parth for where the data is stored.
+            e.g '/home/users/zd907959/'
+
+        filenames (list): The filenames of the .netcdf files, in time order
+            e.g. ['ERA5_1979_01.nc','ERA5_1979_02.nc']
+
+        nc_key (str): The string you need to load the .nc data 
+            e.g. 't2m','rsds'
+
+        workers (int): The number of processes to use, by default the 
+            number of CPUs.
+
+        cache_dir (str): Optional folder to save the country mask in, so 
+            it is only calculated once for each country and grid.
+
+        backend (str): How the country mask is calculated, 'shapely' 
+            (default), 'numba' or 'rasterio'.
+
+        subset (bool): If True the data and mask returned cover the bounding
+            box of the country rather than the whole grid, as for 
+            load_country_weather_data. The lats/lons of the box are given by
+            load_country_weather_coords.
+
+    Returns:
+
+        country_masked_data (array): Country-masked weather data, dimensions 
+            [time,lat,lon] where there are 0's in locations where the data is 
+            not within the country border, with the files joined along time.
+
+        MASK_MATRIX_RESHAPE (array): Dimensions [lat,lon] where there are 1's if 
+           the data is within a country border and zeros if data is outside a 
+           country border. 
+
+    """
+
+    # the mask is calculated once from the grid of the first file, only its
+    # coordinates are read here
+    lats, lons = _read_era5_coords(data_dir + filenames[0])
+    lat_slice, lon_slice = _country_slices(COUNTRY,lats,lons)
+    if subset:
+        MASK_MATRIX_RESHAPE = _load_country_mask(COUNTRY,lats[lat_slice],
+                                                 lons[lon_slice],cache_dir,backend)
+        box_cells = MASK_MATRIX_RESHAPE.astype(bool)
+    else:
+        MASK_MATRIX_RESHAPE = _load_country_mask(COUNTRY,lats,lons,cache_dir,backend)
+        box_cells = MASK_MATRIX_RESHAPE[lat_slice,lon_slice].astype(bool)
+
+    # each file only reads the bounding box of the country and sends back
+    # the gridpoints within it
+    file_strs = [data_dir + filename for filename in filenames]
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('forkserver')
+    else:
+        mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=mp_context) as executor:
+        file_cells = list(executor.map(_load_masked_cells,file_strs,
+                                       [nc_key]*len(file_strs),
+                                       [lat_slice]*len(file_strs),
+                                       [lon_slice]*len(file_strs),
+                                       [box_cells]*len(file_strs)))
+
+    # put the gridpoints back on the grid, zeros outside the country
+    n_time = sum([len(cells) for cells in file_cells])
+    country_masked_data = np.zeros((n_time,) + MASK_MATRIX_RESHAPE.shape,
+                                   dtype=file_cells[0].dtype)
+    country_cells = MASK_MATRIX_RESHAPE.astype(bool)
+    time_index = 0
+    for cells in file_cells:
+        country_masked_data[time_index:time_index + len(cells),country_cells] = cells
+        time_index = time_index + len(cells)
+
+    return(country_masked_data,MASK_MATRIX_RESHAPE)
+
+
+
+def load_country_weather_data_mf(COUNTRY,glob_pattern,nc_key,cache_dir=None,
+                                 backend='shapely'):
+
+    """
+    This function lazily loads many ERA5 files (e.g. all the months of a 
+    multi-year run) with xarray and dask, and applies the country mask, which
+    is only calculated once. Nothing is read until the result is computed,
+    and then the files are streamed through in chunks, so the data can be 
+    larger than the memory available.
+
+    Args:
+        COUNTRY (str): This must be a name of a country (or set of) e.g. 
+            'United Kingdom','France','Czech Republic'
+
+        glob_pattern (str): The path and pattern of the .netcdf files
+            e.g. '/home/users/zd907959/ERA5_1hr_*_DET.nc'
+
+        nc_key (str): The string you need to load the .nc data 
+            e.g. 't2m','rsds'
+
+        cache_dir (str): Optional folder to save the country mask in, so 
+            it is only calculated once for each country and grid.
+
+        backend (str): How the country mask is calculated, 'shapely' 
+            (default), 'numba' or 'rasterio'.
+
+    Returns:
+
+        country_masked_data (xarray.DataArray): Lazy country-masked weather 
+            data, dimensions [time,latitude,longitude] where there are 0's in
+            locations where the data is not within the country border. It can
+            be passed straight to solar_PV_model, calc_hdd_cdd and 
+            compute_country_timeseries, which return lazy [time] timeseries,
+            so only those need computing (e.g. with .values).
+
+        country_mask (xarray.DataArray): Dimensions [latitude,longitude] where 
+           there are 1's if the data is within a country border and zeros if 
+           data is outside a country border. 
+
+    """
+
+    try:
+        import xarray as xr
+    except ImportError:
+        raise ImportError("xarray and dask are needed for load_country_weather_data_mf")
+
+    dataset = xr.open_mfdataset(glob_pattern,combine='by_coords',parallel=True,
+                                chunks={'time':744})
+    data = dataset[nc_key].astype(np.float32)
 
     # get data in appropriate units for models
     if nc_key == 't2m':
-        data = data-273.15 # convert to Kelvin from Celsius
+        data = data - 273.15 # convert to Kelvin from Celsius
     if nc_key == 'ssrd':
         data = data/3600. # convert Jh-1m-2 to Wm-2
 
-    LONS, LATS = np.meshgrid(lons,lats) # make grids of the lat and lon data
-    x, y = LONS.flatten(), LATS.flatten() # flatten these to make it easier to 
-    #loop over.
-    points = np.vstack((x,y)).T
-    MASK_MATRIX = np.zeros((len(x),1))
-    # loop through all the lat/lon combinations to get the masked points
-    for i in range(0,len(x)):
-        my_point = shapely.geometry.Point(x[i],y[i]) 
-        if country_shapely[0].contains(my_point) == True: 
-            MASK_MATRIX[i,0] = 1.0 # creates 1s and 0s where the country is
-    
-    MASK_MATRIX_RESHAPE = np.reshape(MASK_MATRIX,(len(lats),len(lons)))
-
-    # now apply the mask to the data that has been loaded in:
-
-    country_masked_data = data*MASK_MATRIX_RESHAPE
-                                     
+    # get the mask of the gridpoints within the country
+    lats = dataset['latitude'].values
+    lons = dataset['longitude'].values
+    country_mask = xr.DataArray(_load_country_mask(COUNTRY,lats,lons,cache_dir,
+                                                   backend),
+                                coords={'latitude':lats,'longitude':lons},
+                                dims=('latitude','longitude'))
+
+    # now apply the mask to the data, this is only done when it is computed
+    country_masked_data = data.where(country_mask == 1,0.)
+
+    return(country_masked_data,country_mask)
 
 
-    return(country_masked_data,MASK_MATRIX_RESHAPE)
 
+def _is_dataarray(data):
 
-def solar_PV_model(country_masked_data_T2m,country_masked_data_ssrd):
+    """
+    Checks if data is an xarray DataArray (e.g. from 
+    load_country_weather_data_mf) without importing xarray.
+    """
+
+    return(type(data).__module__.split('.')[0] == 'xarray')
+
+
+def _xr_spatial_mean(data,country_mask,lats=None):
+
+    """
+    This function averages the gridpoints within a country at each timestep
+    for xarray data, e.g. from load_country_weather_data_mf. If the data is
+    lazy the result is too, so the data is streamed through in chunks when it
+    is computed rather than loaded at once.
+
+    Args:
+
+        data (xarray.DataArray): Dimensions [time,latitude,longitude], 
+            country-masked data.
+        country_mask (array): dimensions [latitude,longitude] with 1's within
+            a country border and 0 outside of it, as a DataArray or an array.
+        lats (array): Optional, if given the gridpoints are weighted by 
+            cos(latitude) (their area) rather than equally. The latitudes of 
+            the data are used.
+    Returns:
+
+        spatial_mean (xarray.DataArray): Dimensions [time], the country mean.
+
+    """
+
+    if not _is_dataarray(country_mask):
+        country_mask = data[{'time':0}].drop_vars('time',errors='ignore').copy(
+            data=np.asarray(country_mask))
+
+    if not country_mask.any():
+        raise ValueError("the country mask has no gridpoints within the country,"
+                         " check the grid covers the country")
+
+    weights = country_mask.astype(data.dtype)
+    if lats is not None:
+        # gridboxes shrink towards the poles, so weight by cos(latitude)
+        weights = weights*np.cos(np.deg2rad(weights['latitude'])).astype(data.dtype)
+
+    # skipna=False so missing data gives nan, as with numpy arrays
+    return(data.weighted(weights).mean(('latitude','longitude'),skipna=False))
+
+
+def _cell_weights(country_mask,lats=None):
+
+    """
+    This function calculates the normalised weights of the gridpoints within
+    a country, so that a spatial mean is a single dot product with them.
+
+    Args:
+
+        country_mask (array): dimensions [lat,lon] with 1's within a country 
+            border and 0 outside of it. 
+        lats (array): Optional, dimensions [lat]. The latitudes of the mask,
+            if given the gridpoints are weighted by cos(latitude) (their area)
+            rather than equally.
+    Returns:
+
+        cell_weights (array): Dimensions [n_cells], weights of the gridpoints
+            within the country (in the order of data[...,country_mask==1]) 
+            which sum to 1. A ValueError is raised if there are none, e.g. if
+            the grid does not cover the country.
+
+    """
+
+    country_cells = np.asarray(country_mask,dtype=bool)
+    if not country_cells.any():
+        raise ValueError("the country mask has no gridpoints within the country,"
+                         " check the grid covers the country")
+
+    if lats is None:
+        cell_weights = np.ones(np.count_nonzero(country_cells))
+    else:
+        # gridboxes shrink towards the poles, so weight by cos(latitude).
+        # broadcast_to avoids making a full [lat,lon] array of weights.
+        cell_weights = np.broadcast_to(np.cos(np.deg2rad(lats))[:,None],
+                                       np.shape(country_mask))[country_cells]
+
+    return(cell_weights/cell_weights.sum())
+
+
+def _spatial_mean(cells,cell_weights):
+
+    """
+    This function averages the gridpoints within a country at each timestep,
+    as a matrix-vector product (BLAS GEMV) with the normalised weights.
+
+    Args:
+
+        cells (array): Dimensions [time,n_cells] or [n_cells], the data at the 
+            gridpoints within the country, i.e. data[...,country_mask==1].
+        cell_weights (array): Dimensions [n_cells], from _cell_weights.
+    Returns:
+
+        spatial_mean (array): Dimensions [time], the country mean.
+
+    """
+
+    # match the dtype so float32 data is not copied up to float64
+    return(np.asarray(cells) @ cell_weights.astype(cells.dtype,copy=False))
+
+
+def _solar_cf(T2m_cells,ssrd_cells):
+
+    """
+    This function converts 2m temperature (celsius) and surface solar 
+    irradiance (Wm-2) into solar power capacity factor at each gridpoint,
+    see solar_PV_model.
+
+    """
+
+    # the constants are in the dtype of the data, as python floats would make
+    # numexpr promote float32 data to float64
+    dtype = np.result_type(T2m_cells.dtype,ssrd_cells.dtype,np.float32).type
+
+   # reference values, see Evans and Florschuetz, (1977)
+    T_ref = dtype(25.)
+    eff_ref = dtype(0.9) #adapted based on Bett and Thornton (2016)
+    beta_ref = dtype(0.0042)
+    G_ref = dtype(1000.)
+
+    if _is_dataarray(T2m_cells):
+        # xarray data is left to xarray (and dask), so it stays lazy
+        return(eff_ref*(1 - beta_ref*(T2m_cells - T_ref))*(ssrd_cells/G_ref))
+
+    # evaluate the relative efficiency and capacity factor in a single pass
+    capacity_factor_of_pannel = ne.evaluate(
+        'eff_ref*(1 - beta_ref*(T2m - T_ref))*(ssrd/G_ref)',
+        local_dict={'T2m':T2m_cells,'ssrd':ssrd_cells,'eff_ref':eff_ref,
+                    'beta_ref':beta_ref,'T_ref':T_ref,'G_ref':G_ref})
+
+    return(capacity_factor_of_pannel)
+
+
+def _hdd_cdd(spatial_mean_t2m):
+
+    """
+    This function converts a country mean 2m temperature (celsius) into 
+    heating and cooling degree days, see calc_hdd_cdd.
+
+    """
+
+    HDD_term = np.maximum(15.5 - spatial_mean_t2m,0.)
+    CDD_term = np.maximum(spatial_mean_t2m - 22.0,0.)
+
+    return(HDD_term,CDD_term)
+
+
+def _hdd_cdd_weighted(t2m_cells,cell_weights):
+
+    """
+    This function calculates heating and cooling degree days straight from 
+    the gridpoints within a country, fusing the spatial mean and the degree
+    days into one pass over the data. It is compiled with numba by _jit and 
+    runs in parallel over time.
+
+    Args:
+
+        t2m_cells (array): Dimensions [time,n_cells], the 2m temperatures 
+            (celsius) at the gridpoints within the country.
+        cell_weights (array): Dimensions [n_cells], from _cell_weights.
+    Returns:
+
+        HDD_term (array): Dimesions [time], Timeseries of heating degree days
+        CDD_term (array): Dimesions [time], Timeseries of cooling degree days
+
+    """
+
+    # same dtype as the data, to match the numpy path in calc_hdd_cdd
+    len_time = t2m_cells.shape[0]
+    HDD_term = np.empty(len_time,dtype=t2m_cells.dtype)
+    CDD_term = np.empty(len_time,dtype=t2m_cells.dtype)
+    for i in prange(len_time):
+        spatial_mean_t2m = 0.
+        for j in range(t2m_cells.shape[1]):
+            spatial_mean_t2m += t2m_cells[i,j]*cell_weights[j]
+        HDD_term[i] = max(15.5 - spatial_mean_t2m,0.)
+        CDD_term[i] = max(spatial_mean_t2m - 22.0,0.)
+
+    return(HDD_term,CDD_term)
+
+
+def solar_PV_model(country_masked_data_T2m,country_masked_data_ssrd,country_mask,
+                   lats=None):
 
     """
 
@@ -98,28 +879,35 @@ def solar_PV_model(country_masked_data_T2m,country_masked_data_ssrd):
     Args:
 
         country_masked_data_T2m (array): array of 2m temperatures, Dimensions 
-            [time, lat,lon] or [lat,lon] in units of celsius.
+            [time, lat,lon] or [lat,lon] in units of celsius. This can also 
+            be a (lazy) xarray.DataArray from load_country_weather_data_mf.
         country_masked_data_ssrd (array): array of surface solar irradiance, 
             Dimensions [time, lat,lon] or [lat,lon]in units of Wm-2.
+        country_mask (array): dimensions [lat,lon] with 1's within a country 
+            border and 0 outside of it. 
+        lats (array): Optional, dimensions [lat]. The latitudes of the mask,
+            if given the gridpoints are weighted by cos(latitude) (their area)
+            rather than equally.
     Returns:
 
         spatial_mean_solar_cf (array): Dimesions [time], Timeseries of solar 
-            power capacity factor, varying between 0 and 1.
+            power capacity factor, varying between 0 and 1. A lazy 
+            xarray.DataArray for xarray input.
 
 
     """
-   # reference values, see Evans and Florschuetz, (1977)
-    T_ref = 25. 
-    eff_ref = 0.9 #adapted based on Bett and Thornton (2016)
-    beta_ref = 0.0042
-    G_ref = 1000.
- 
-    rel_efficiency_of_pannel = eff_ref*(1 - beta_ref*(Masked_T2m - T_ref))
-    capacity_factor_of_pannel = np.nan_to_num(rel_efficiency_of_pannel*
-                                              (Masked_SWGDN/G_ref)) 
-
-    spatial_mean_solar_cf = np.average(capacity_factor_of_pannel,
-                                       weights=MASK_MATRIX_RESHAPE)
+    if _is_dataarray(country_masked_data_T2m):
+        capacity_factor_of_pannel = _solar_cf(country_masked_data_T2m,
+                                              country_masked_data_ssrd)
+        return(_xr_spatial_mean(capacity_factor_of_pannel,country_mask,lats))
+
+    # only keep the gridpoints within the country, dimensions [time,n_cells]
+    country_cells = np.asarray(country_mask,dtype=bool)
+    capacity_factor_of_pannel = _solar_cf(country_masked_data_T2m[...,country_cells],
+                                          country_masked_data_ssrd[...,country_cells])
+
+    spatial_mean_solar_cf = _spatial_mean(capacity_factor_of_pannel,
+                                          _cell_weights(country_mask,lats))
 
     return(spatial_mean_solar_cf)
 
@@ -127,7 +915,7 @@ def solar_PV_model(country_masked_data_T2m,country_masked_data_ssrd):
 
 
 
-def calc_hdd_cdd(t2m_array,country_mask):
+def calc_hdd_cdd(t2m_array,country_mask,lats=None):
 
     """
 
@@ -139,9 +927,14 @@ def calc_hdd_cdd(t2m_array,country_mask):
     Args:
 
         t2m_array (array): array of country_masked 2m temperatures, Dimensions 
-            [time, lat,lon] or [lat,lon] in units of celsius. 
+            [time, lat,lon] or [lat,lon] in units of celsius. This can also 
+            be a (lazy) xarray.DataArray from load_country_weather_data_mf, 
+            then HDD_term and CDD_term are lazy xarray.DataArrays.
         country_mask (array): array of the country mask applied to the t2m data 
             Dimensions [lat,lon] with 1's for gridpoints within the country.
+        lats (array): Optional, dimensions [lat]. The latitudes of the mask,
+            if given the gridpoints are weighted by cos(latitude) (their area)
+            rather than equally.
     Returns:
 
         HDD_term (array): Dimesions [time], Timeseries of heating degree days
@@ -150,28 +943,91 @@ def calc_hdd_cdd(t2m_array,country_mask):
 
     """
 
-    spatial_mean_t2m = np.average(t2m_array,weights=country_mask)
-    timeseries_len = len(spatial_mean_t2m)
+    # note the function works on daily temperatures. so make sure these are daily!
 
-    HDD_term = np.zeros(timeseries_len)
-    CDD_term = np.zeros(len)
+    if _is_dataarray(t2m_array):
+        return(_hdd_cdd(_xr_spatial_mean(t2m_array,country_mask,lats)))
 
-    for i in range(0,len_of_training_period):
-        if spatial_mean_t2m[i] <= 15.5:
-            HDD_term[i] = 15.5 - spatial_mean_t2m[i]
-        else:
-            HDD_term[i] =0
+    # average the gridpoints within the country at each timestep
+    country_cells = np.asarray(country_mask,dtype=bool)
+    t2m_cells = np.asarray(t2m_array[...,country_cells])
+    cell_weights = _cell_weights(country_mask,lats)
 
-    for i in range(0,len_of_training_period):
-        if spatial_mean_t2m[i] >= 22.0:
-            CDD_term[i] = spatial_mean_t2m[i] - 22.0
-        else:
-            CDD_term[i] =0
+    if t2m_cells.ndim == 2:
+        hdd_cdd_weighted = _jit('_hdd_cdd_weighted')
+    else:
+        hdd_cdd_weighted = None
+
+    if hdd_cdd_weighted is not None:
+        HDD_term, CDD_term = hdd_cdd_weighted(t2m_cells,
+                                              cell_weights.astype(t2m_cells.dtype))
+    else:
+        HDD_term, CDD_term = _hdd_cdd(_spatial_mean(t2m_cells,cell_weights))
 
 
     return(HDD_term,CDD_term)
 
 
+def compute_country_timeseries(country_masked_data_T2m,country_masked_data_ssrd,
+                               country_mask,lats=None):
+
+    """
+
+    This function takes in arrays of country_masked 2m temperature (celsius)
+    and surface solar irradiance (Wm-2) and calculates all the country
+    timeseries at once, picking out the gridpoints within the country only
+    once rather than in both solar_PV_model and calc_hdd_cdd.
+
+    Args:
+
+        country_masked_data_T2m (array): array of 2m temperatures, Dimensions 
+            [time, lat,lon] or [lat,lon] in units of celsius. This can also 
+            be a (lazy) xarray.DataArray from load_country_weather_data_mf.
+        country_masked_data_ssrd (array): array of surface solar irradiance, 
+            Dimensions [time, lat,lon] or [lat,lon]in units of Wm-2.
+        country_mask (array): dimensions [lat,lon] with 1's within a country 
+            border and 0 outside of it. 
+        lats (array): Optional, dimensions [lat]. The latitudes of the mask,
+            if given the gridpoints are weighted by cos(latitude) (their area)
+            rather than equally.
+    Returns:
+
+        country_timeseries (CountryTimeseries): a namedtuple of timeseries, 
+            all with dimensions [time]:
+            mean_t2m, the country mean 2m temperature (celsius),
+            mean_ssrd, the country mean surface solar irradiance (Wm-2),
+            solar_cf, the solar power capacity factor (as solar_PV_model),
+            HDD and CDD, the heating and cooling degree days (as calc_hdd_cdd).
+            For xarray input these are lazy xarray.DataArrays, which can be 
+            computed together with dask.compute(*country_timeseries).
+
+
+    """
+
+    if _is_dataarray(country_masked_data_T2m):
+        mean_t2m = _xr_spatial_mean(country_masked_data_T2m,country_mask,lats)
+        mean_ssrd = _xr_spatial_mean(country_masked_data_ssrd,country_mask,lats)
+        solar_cf = _xr_spatial_mean(_solar_cf(country_masked_data_T2m,
+                                              country_masked_data_ssrd),
+                                    country_mask,lats)
+        HDD_term, CDD_term = _hdd_cdd(mean_t2m)
+        return(CountryTimeseries(mean_t2m,mean_ssrd,solar_cf,HDD_term,CDD_term))
+
+    # only keep the gridpoints within the country, dimensions [time,n_cells]
+    country_cells = np.asarray(country_mask,dtype=bool)
+    T2m_cells = country_masked_data_T2m[...,country_cells]
+    ssrd_cells = country_masked_data_ssrd[...,country_cells]
+
+    # the weights are normalised once and shared by all the spatial means
+    cell_weights = _cell_weights(country_mask,lats)
+    mean_t2m = _spatial_mean(T2m_cells,cell_weights)
+    mean_ssrd = _spatial_mean(ssrd_cells,cell_weights)
+    solar_cf = _spatial_mean(_solar_cf(T2m_cells,ssrd_cells),cell_weights)
+    HDD_term, CDD_term = _hdd_cdd(mean_t2m)
+
+    return(CountryTimeseries(mean_t2m,mean_ssrd,solar_cf,HDD_term,CDD_term))
+
+
 def calc_national_wd_demand_2017(hdd,cdd,filestr_reg_coefficients,COUNTRY):
 
 
@@ -1,10 +1,10 @@
 import numpy as np
-import cartopy.io.shapereader as shpreader
-from netCDF4 import Dataset
-import shapely.geometry
+from energy_model_functions import load_country_weather_data, \
+    load_country_weather_coords, calc_hdd_cdd
 
 
-def load_country_weather_data_daily(COUNTRY,data_dir,filename,nc_key,hourflag):
+def load_country_weather_data_daily(COUNTRY,data_dir,filename,nc_key,hourflag,
+                                    cache_dir=None,backend='shapely',subset=False):
 
     """
     This function takes the ERA5 reanalysis data, loads it and applied a 
@@ -30,6 +30,17 @@ def load_country_weather_data_daily(COUNTRY,data_dir,filename,nc_key,hourflag):
         hourflag (int): This is either 1 or 0, if daily data =0, if
            hourly data = 1.
 
+        cache_dir (str): Optional folder to save the country mask in, so 
+            it is only calculated once for each country and grid.
+
+        backend (str): How the country mask is calculated, 'shapely' 
+            (default), 'numba' or 'rasterio'.
+
+        subset (bool): If True only the bounding box of the country is read
+            from the file, and the data and mask returned cover that box 
+            rather than the whole grid. The lats/lons of the box are given by
+            load_country_weather_coords.
+
     Returns:
 
         country_masked_data (array): Country-masked daily weather data,
@@ -44,106 +55,22 @@ def load_country_weather_data_daily(COUNTRY,data_dir,filename,nc_key,hourflag):
     """
 
 
-    # first loop through the countries and extract the appropraite shapefile
-    countries_shp = shpreader.natural_earth(resolution='10m',category='cultural',
-                                            name='admin_0_countries')
-    country_shapely = []
-    for country in shpreader.Reader(countries_shp).records():
-        if country.attributes['NAME_LONG'] == COUNTRY:
-            print('Found country')
-            country_shapely.append(country.geometry)
-
-    # load in the data you wish to mask
-    file_str = data_dir + filename
-    dataset = Dataset(file_str,mode='r')
-    lons = dataset.variables['longitude'][:]
-    lats = dataset.variables['latitude'][:]
-    data = dataset.variables[nc_key][:] # data in shape [time,lat,lon]
-    dataset.close()
-
-    # get data in appropriate units for models
-    if nc_key == 't2m':
-        data = data-273.15 # convert to Kelvin from Celsius
-    if nc_key == 'ssrd':
-        data = data/3600. # convert Jh-1m-2 to Wm-2
+    # load in the data and apply the country mask, as for hourly data
+    country_masked_data, MASK_MATRIX_RESHAPE = load_country_weather_data(
+        COUNTRY,data_dir,filename,nc_key,cache_dir,backend,subset)
 
     if hourflag == 1: # if hourly data convert to daily
-        data = np.mean ( np.reshape(data, (len(data)/24,24,len(lats),len(lons))),axis=1)
+        country_masked_data = np.mean(np.reshape(country_masked_data,
+                                                 (len(country_masked_data)//24,24) +
+                                                 country_masked_data.shape[1:]),axis=1)
         print('Converting to daily-mean')
     if hourflag ==0:
         print('data is daily (if not consult documentation!)')
 
-    LONS, LATS = np.meshgrid(lons,lats) # make grids of the lat and lon data
-    x, y = LONS.flatten(), LATS.flatten() # flatten these to make it easier to 
-    #loop over.
-    points = np.vstack((x,y)).T
-    MASK_MATRIX = np.zeros((len(x),1))
-    # loop through all the lat/lon combinations to get the masked points
-    for i in range(0,len(x)):
-        my_point = shapely.geometry.Point(x[i],y[i]) 
-        if country_shapely[0].contains(my_point) == True: 
-            MASK_MATRIX[i,0] = 1.0 # creates 1s and 0s where the country is
-    
-    MASK_MATRIX_RESHAPE = np.reshape(MASK_MATRIX,(len(lats),len(lons)))
-
-    # now apply the mask to the data that has been loaded in:
-
-    country_masked_data = data*MASK_MATRIX_RESHAPE
-                                     
-
 
     return(country_masked_data,MASK_MATRIX_RESHAPE)
 
 
-def calc_hdd_cdd(t2m_array,country_mask):
-
-    """
-
-    This function takes in an array of country_masked 2m temperature (celsius)
-    and converts this into a time series of heating-degree days (HDD) and cooling
-    degree days (CDD) using the method from Bloomfield et al.,(2020) 
-    https://doi.org/10.1002/met.1858
-
-    Args:
-
-        t2m_array (array): array of country_masked 2m temperatures, Dimensions 
-            [time, lat,lon] or [lat,lon] in units of celsius. 
-        country_mask (array): array of the country mask applied to the t2m data 
-            Dimensions [lat,lon] with 1's for gridpoints within the country.
-    Returns:
-
-        HDD_term (array): Dimesions [time], timeseries of heating degree days
-        CDD_term (array): Dimesions [time], timeseries of cooling degree days
-
-
-    """
-    len_time = np.shape(t2m_array)[0]
-
-    spatial_mean_t2m =np.zeros(len_time)
-    for i in range(0,len_time):
-        spatial_mean_t2m[i] = np.average(t2m_array[i,:,:],weights=country_mask)
-
-    # note the function works on daily temperatures. so make sure these are daily!
-
-    HDD_term = np.zeros(len_time)
-    CDD_term = np.zeros(len_time)
-
-    for i in range(0,len_time):
-        if spatial_mean_t2m[i] <= 15.5:
-            HDD_term[i] = 15.5 - spatial_mean_t2m[i]
-        else:
-            HDD_term[i] =0
-
-    for i in range(0,len_time):
-        if spatial_mean_t2m[i] >= 22.0:
-            CDD_term[i] = spatial_mean_t2m[i] - 22.0
-        else:
-            CDD_term[i] =0
-
-
-    return(HDD_term,CDD_term)
-
-
 def calc_national_wd_demand_2017(hdd,cdd,filestr_reg_coefficients,COUNTRY):
 
 
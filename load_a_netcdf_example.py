@@ -1,5 +1,4 @@
-import numpy as np
-from netCDF4 import Dataset
+from _era5_io import _read_era5
 
 def load_weather_data_daily(data_dir,filename,nc_key):
 
@@ -31,19 +30,8 @@ def load_weather_data_daily(data_dir,filename,nc_key):
 
     """
  
-    # load in the data you wish to mask
-    file_str = data_dir + filename
-    dataset = Dataset(file_str,mode='r')
-    lons = dataset.variables['longitude'][:]
-    lats = dataset.variables['latitude'][:]
-    data = dataset.variables[nc_key][:] # data in shape [time,lat,lon]
-    dataset.close()
-
-    # get data in appropriate units for models
-    if nc_key == 't2m':
-        data = data-273.15 # convert to Kelvin from Celsius
-    if nc_key == 'ssrd':
-        data = data/3600. # convert Jh-1m-2 to Wm-2
+    # load in the data, in float32 and appropriate units for models
+    data, lats, lons = _read_era5(data_dir + filename,nc_key)
                             
 
 
@@ -59,6 +47,7 @@ def load_weather_data_daily(data_dir,filename,nc_key):
 #
 ##############
 
-ERA5_data_jan_1979,lats,lons = load_weather_data_daily('/storage/silver/S2S4E/energymet/ERA5/native_grid_hourly/','ERA5_1hr_1979_01_DET.nc','t2m')
+if __name__ == '__main__':
+    ERA5_data_jan_1979,lats,lons = load_weather_data_daily('/storage/silver/S2S4E/energymet/ERA5/native_grid_hourly/','ERA5_1hr_1979_01_DET.nc','t2m')
 
 